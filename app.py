@@ -1,39 +1,75 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for
+from quart import Quart, Response, render_template, request, jsonify, session, redirect, url_for, stream_with_context
+from quart.json.provider import DefaultJSONProvider
+from collections import deque
+from cachetools import TTLCache
+import redis.asyncio as redis
+import msgpack
+import asyncio
+import hashlib
+import httpx
 import uuid
 import os
+import orjson
 from datetime import datetime
 
-app = Flask(__name__)
+class ORJSONProvider(DefaultJSONProvider):
+    """Route jsonify and request.get_json through orjson"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+app = Quart(__name__)
+app.json = ORJSONProvider(app)
 # Use environment variable for secret key
 app.secret_key = os.environ.get('SECRET_KEY', os.urandom(24))
 
 # Import OpenAI conditionally to avoid issues
 try:
-    from openai import OpenAI
+    from openai import AsyncOpenAI
 except ImportError:
     print("OpenAI library not found. Please install it.")
-    OpenAI = None
+    AsyncOpenAI = None
+
+# Semantic cache is optional - it needs sentence-transformers and faiss
+try:
+    from sentence_transformers import SentenceTransformer
+    import faiss
+except ImportError:
+    print("sentence-transformers/faiss not found. Semantic cache disabled.")
+    SentenceTransformer = None
+    faiss = None
 
 # Use environment variable for API choice
 API_PROVIDER = os.environ.get('API_PROVIDER', 'groq').lower()
 
 print(f"Starting with API_PROVIDER: {API_PROVIDER}")
 
+# One shared HTTP/2 connection pool so LLM calls reuse TCP+TLS and multiplex streams
+http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=32, max_connections=64)
+)
+
 if API_PROVIDER == 'groq':
     # Groq API (for deployment - FREE and FAST!)
     groq_key = os.environ.get('GROQ_API_KEY')
     if not groq_key:
         raise ValueError("GROQ_API_KEY environment variable is required when using Groq")
     
-    client = OpenAI(
+    client = AsyncOpenAI(
         base_url="https://api.groq.com/openai/v1",
-        api_key=groq_key
+        api_key=groq_key,
+        http_client=http_client
     )
     # Updated models as of Jan 2026
-    MODEL = "llama-3.3-70b-versatile"  # Latest and best (recommended)
-    print(f"Using Groq with model: {MODEL}")
+    # Short casual chat turns run on the fast 8B model; analysis keeps the 70B
+    CHAT_MODEL = os.environ.get('CHAT_MODEL', "llama-3.1-8b-instant")
+    ANALYSIS_MODEL = os.environ.get('ANALYSIS_MODEL', "llama-3.3-70b-versatile")
+    print(f"Using Groq with models: {CHAT_MODEL} (chat), {ANALYSIS_MODEL} (analysis)")
     # Alternative models:
-    # "llama-3.1-8b-instant" - Faster, lighter
     # "mixtral-8x7b-32768" - Good balance
     # "gemma2-9b-it" - Compact and efficient
 elif API_PROVIDER == 'openai':
@@ -42,19 +78,100 @@ elif API_PROVIDER == 'openai':
     if not openai_key:
         raise ValueError("OPENAI_API_KEY environment variable is required when using OpenAI")
     
-    client = OpenAI(api_key=openai_key)
-    MODEL = "gpt-3.5-turbo"
-    print(f"Using OpenAI with model: {MODEL}")
+    client = AsyncOpenAI(api_key=openai_key, http_client=http_client)
+    CHAT_MODEL = os.environ.get('CHAT_MODEL', "gpt-3.5-turbo")
+    ANALYSIS_MODEL = os.environ.get('ANALYSIS_MODEL', "gpt-3.5-turbo")
+    print(f"Using OpenAI with models: {CHAT_MODEL} (chat), {ANALYSIS_MODEL} (analysis)")
 else:
-    # Ollama (for local development)
-    client = OpenAI(
-        base_url="http://localhost:11434/v1",
-        api_key="ollama"
+    # Ollama (for local development). Any OpenAI-compatible local server works;
+    # vLLM with prefix caching prefills the shared SYSTEM_PROMPT once instead of
+    # per conversation:
+    #   vllm serve meta-llama/Llama-3.2-3B-Instruct --enable-prefix-caching
+    #   LOCAL_LLM_URL=http://localhost:8000/v1 CHAT_MODEL=meta-llama/Llama-3.2-3B-Instruct
+    client = AsyncOpenAI(
+        base_url=os.environ.get('LOCAL_LLM_URL', "http://localhost:11434/v1"),
+        api_key="ollama",
+        http_client=http_client
     )
-    MODEL = "llama3.2"
-    print(f"Using Ollama with model: {MODEL}")
+    CHAT_MODEL = os.environ.get('CHAT_MODEL', "llama3.2")
+    # Default to the chat model so a server hosting a single model needs one setting
+    ANALYSIS_MODEL = os.environ.get('ANALYSIS_MODEL', CHAT_MODEL)
+    print(f"Using Ollama with models: {CHAT_MODEL} (chat), {ANALYSIS_MODEL} (analysis)")
+
+# Conversation state lives in Redis when REDIS_URL is set so every worker sees
+# the same sessions; otherwise fall back to an in-process cache for local dev
+REDIS_URL = os.environ.get('REDIS_URL')
+CONVERSATION_TTL = 3600
+MAX_CONVERSATIONS = 5000
+
+if REDIS_URL:
+    redis_client = redis.Redis(
+        connection_pool=redis.ConnectionPool.from_url(REDIS_URL, max_connections=64)
+    )
+    print("Storing conversations in Redis")
+else:
+    redis_client = None
+
+# Each conversation stores its messages as parallel role codes and contents;
+# the OpenAI-style dict list is only built when a request needs it
+ROLE_SYSTEM, ROLE_USER, ROLE_ASSISTANT = 0, 1, 2
+ROLE_NAMES = ("system", "user", "assistant")
+
+# Idle conversations expire after CONVERSATION_TTL; every save re-inserts and
+# so restarts the clock. When full, the least recently used are evicted.
+conversations = TTLCache(maxsize=MAX_CONVERSATIONS, ttl=CONVERSATION_TTL)
+# Conversations waiting on a Batch API analysis live outside the cache, so
+# neither expiry nor eviction drops them before their result arrives
+awaiting_batch = {}
+# Serialises turns within a conversation; different conversations run concurrently
+conversation_locks = TTLCache(maxsize=MAX_CONVERSATIONS, ttl=CONVERSATION_TTL)
+
+# Analyses run in the background after /end_conversation returns
+ANALYSIS_POLL_INTERVAL = 0.5  # seconds
+ANALYSIS_WAIT_TIMEOUT = 120  # seconds
+pending_analyses = {}
+
+# With OpenAI, analyses can go through the Batch API at half the token price,
+# at the cost of minutes (up to 24h) of latency. Opt in with ANALYSIS_BATCH=1.
+USE_BATCH_API = API_PROVIDER == 'openai' and os.environ.get('ANALYSIS_BATCH', '').lower() in ('1', 'true')
+ANALYSIS_BATCH_INTERVAL = 60  # seconds between batch submissions
+ANALYSIS_BATCH_POLL = 30  # seconds between batch status checks
+ANALYSIS_BATCH_WINDOW = "24h"
+# Conversations waiting on a batch must outlive its completion window
+ANALYSIS_BATCH_TTL = 25 * 3600
+queued_analyses = []
+analysis_batch_task = None
+running_batches = {}  # poller task -> (batch id, conversation ids)
+
+# Exact-match cache of completions, keyed by a hash of the full request
+RESP_CACHE = TTLCache(maxsize=10000, ttl=3600)
+
+# Pre-generated opening lines so starting a conversation never waits on the LLM
+GREETING_POOL_SIZE = 20
+GREETING_REFILL_AT = 5
+greeting_pool = deque()
+greeting_refill_task = None
+
+# Semantic cache: embeddings of (previous AI turn + user turn) -> AI reply
+SEMANTIC_THRESHOLD = 0.95
+SEMANTIC_MAX_ENTRIES = 10000
+
+if SentenceTransformer is not None and faiss is not None:
+    embedder = SentenceTransformer('all-MiniLM-L6-v2')
+    semantic_index = faiss.IndexFlatIP(384)
+    print("Semantic cache enabled")
+else:
+    embedder = None
+    semantic_index = None
+semantic_replies = []
+
+# Chat requests carry the system prompt, a rolling summary of older turns and
+# only the most recent messages verbatim, so input size stays flat
+HISTORY_WINDOW = 8
+SUMMARY_EVERY = 10
+compaction_tasks = set()
 
-conversations = {}
+ERROR_REPLY = "I'm having trouble connecting right now. Please try again."
 
 SYSTEM_PROMPT = """You are a friendly, engaging conversation partner designed to help users improve their conversation skills. 
 
@@ -69,13 +186,21 @@ Your role:
 
 Remember: You're practicing conversation WITH them, not teaching them. Be warm, curious, and varied in your topics."""
 
-ANALYSIS_PROMPT = """You are an expert conversation coach. You will analyze a conversation where someone practiced their conversation skills with an AI partner.
+# Prompt messages built once and shared by every request
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
 
-In the conversation transcript:
-- "User" represents the PERSON who was practicing (the one you're giving feedback to)
-- "AI" represents the conversation partner (do NOT give feedback about the AI)
+GREETING_MESSAGES = [
+    SYSTEM_MESSAGE,
+    {"role": "user", "content": "Hi! I'd like to practice my conversation skills."}
+]
 
-Your job is to provide constructive feedback to the PERSON (labeled as "User") about THEIR conversation skills.
+ANALYSIS_PROMPT = """The practice conversation is now over. Step out of your role as conversation partner and act as an expert conversation coach analyzing the conversation above.
+
+In the conversation above:
+- The user messages come from the PERSON who was practicing (the one you're giving feedback to)
+- Your own replies were the AI conversation partner (do NOT give feedback about the AI)
+
+Your job is to provide constructive feedback to the PERSON (the "User") about THEIR conversation skills.
 
 Format your response EXACTLY like this:
 
@@ -106,10 +231,79 @@ Format your response EXACTLY like this:
 
 Focus ONLY on the person practicing (User). Use "you" and "your" when addressing them. Be specific and constructive."""
 
-def get_ai_response(messages):
+ANALYSIS_REQUEST = {"role": "user", "content": ANALYSIS_PROMPT}
+
+def conversation_lock(cid):
+    lock = conversation_locks.get(cid) or asyncio.Lock()
+    # Re-insert so an active conversation's lock never expires under it
+    conversation_locks[cid] = lock
+    return lock
+
+async def load_conv(cid):
+    if not cid:
+        return None
+    if redis_client is None:
+        return awaiting_batch.get(cid) or conversations.get(cid)
+
+    raw = await redis_client.get(f"conv:{cid}")
+    if not raw:
+        return None
+    conv = msgpack.unpackb(raw)
+    conv["roles"] = bytearray(conv["roles"])
+    return conv
+
+def conv_ttl(conv):
+    if conv.get("analysis_queued"):
+        return ANALYSIS_BATCH_TTL
+    return CONVERSATION_TTL
+
+async def save_conv(cid, conv):
+    if redis_client is None:
+        if conv.get("analysis_queued"):
+            conversations.pop(cid, None)
+            awaiting_batch[cid] = conv
+        else:
+            awaiting_batch.pop(cid, None)
+            conversations[cid] = conv
+        return
+
+    await redis_client.set(f"conv:{cid}", msgpack.packb(conv), ex=conv_ttl(conv))
+
+def new_conv():
+    return {
+        "roles": bytearray([ROLE_SYSTEM]),
+        "contents": [SYSTEM_PROMPT],
+        "turns": 0,
+        "started_at": datetime.now().isoformat()
+    }
+
+def add_message(conv, role, content):
+    conv["roles"].append(role)
+    conv["contents"].append(content)
+
+def pop_message(conv):
+    conv["roles"].pop()
+    conv["contents"].pop()
+
+def build_messages(conv, start=0, end=None):
+    """Materialise messages[start:end] as OpenAI chat dicts"""
+    return [
+        {"role": ROLE_NAMES[r], "content": c}
+        for r, c in zip(conv["roles"][start:end], conv["contents"][start:end])
+    ]
+
+def cache_key(model, temperature, max_tokens, messages):
+    payload = orjson.dumps([model, temperature, max_tokens, messages], option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(payload).hexdigest()
+
+def sse_frame(payload):
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+async def get_ai_response(messages):
+    # Only used for greetings, which must be fresh samples, so never cached
     try:
-        response = client.chat.completions.create(
-            model=MODEL,
+        response = await client.chat.completions.create(
+            model=CHAT_MODEL,
             messages=messages,
             temperature=0.8,
             max_tokens=300
@@ -117,78 +311,388 @@ def get_ai_response(messages):
         return response.choices[0].message.content
     except Exception as e:
         print(f"AI Error ({API_PROVIDER}):", e)
-        return "I'm having trouble connecting right now. Please try again."
-
-def analyze_conversation(conversation_history):
-    formatted = "\n".join(
-        f"{'User' if m['role']=='user' else 'AI'}: {m['content']}"
-        for m in conversation_history if m['role'] != 'system'
+        return ERROR_REPLY
+
+async def stream_ai_response(messages):
+    """Yield the reply token by token as the model produces it.
+
+    Upstream errors propagate, possibly after some tokens were yielded, so the
+    caller can report the failure instead of mixing error text into the reply.
+    """
+    key = cache_key(CHAT_MODEL, 0.8, 300, messages)
+    if key in RESP_CACHE:
+        yield RESP_CACHE[key]
+        return
+
+    response = await client.chat.completions.create(
+        model=CHAT_MODEL,
+        messages=messages,
+        temperature=0.8,
+        max_tokens=300,
+        stream=True
+    )
+    try:
+        reply = []
+        async for chunk in response:
+            if chunk.choices:
+                token = chunk.choices[0].delta.content or ""
+                if token:
+                    reply.append(token)
+                    yield token
+        RESP_CACHE[key] = "".join(reply)
+    finally:
+        # Release the upstream connection when the client disconnects mid-reply
+        await response.close()
+
+async def semantic_lookup(conv):
+    """Return (embedding, cached reply or None) for the latest user turn"""
+    if embedder is None:
+        return None, None
+
+    roles, contents = conv["roles"], conv["contents"]
+    last_ai = next(
+        (contents[i] for i in range(len(roles) - 1, -1, -1) if roles[i] == ROLE_ASSISTANT), ""
     )
+    text = f"{last_ai}\n{contents[-1]}"
+    # Normalised vectors make inner product equal to cosine similarity
+    vec = await asyncio.to_thread(
+        embedder.encode, [text], normalize_embeddings=True, convert_to_numpy=True
+    )
+    vec = vec.astype('float32')
+
+    if semantic_index.ntotal:
+        D, I = semantic_index.search(vec, 1)
+        if D[0][0] > SEMANTIC_THRESHOLD:
+            return vec, semantic_replies[I[0][0]]
+    return vec, None
+
+def semantic_store(vec, reply):
+    if vec is None or not reply or reply == ERROR_REPLY:
+        return
+    if semantic_index.ntotal >= SEMANTIC_MAX_ENTRIES:
+        semantic_index.reset()
+        semantic_replies.clear()
+    semantic_index.add(vec)
+    semantic_replies.append(reply)
+
+async def fill_greeting_pool():
+    # One at a time, so startup doesn't fire a burst of requests upstream
+    while len(greeting_pool) < GREETING_POOL_SIZE:
+        greeting = await get_ai_response(GREETING_MESSAGES)
+        if greeting == ERROR_REPLY:
+            break
+        greeting_pool.append(greeting)
+
+def schedule_greeting_refill():
+    global greeting_refill_task
+    if greeting_refill_task is None or greeting_refill_task.done():
+        greeting_refill_task = asyncio.create_task(fill_greeting_pool())
+
+def chat_context(conv):
+    """Build the message list sent to the model for the next chat turn"""
+    context = [SYSTEM_MESSAGE]
+    if conv.get("summary"):
+        context.append({"role": "system", "content": "Previously: " + conv["summary"]})
+    return context + build_messages(conv, conv.get("summary_end", 1))
+
+def schedule_compaction(cid):
+    task = asyncio.create_task(compact_history(cid))
+    compaction_tasks.add(task)
+    task.add_done_callback(compaction_tasks.discard)
+
+async def compact_history(cid):
+    """Fold messages older than the window into the stored summary"""
+    conv = await load_conv(cid)
+    if not conv:
+        return
+
+    start = conv.get("summary_end", 1)
+    end = len(conv["contents"]) - HISTORY_WINDOW
+    if end <= start:
+        return
+
+    prompt = [{"role": "system", "content": "You summarize conversations concisely."}]
+    if conv.get("summary"):
+        prompt.append({"role": "system", "content": "Previously: " + conv["summary"]})
+    prompt += build_messages(conv, start, end)
+    prompt.append({"role": "user", "content": "Summarize the conversation so far in 80 words."})
+
+    try:
+        response = await client.chat.completions.create(
+            model=CHAT_MODEL,
+            messages=prompt,
+            temperature=0.3,
+            max_tokens=150
+        )
+        summary = response.choices[0].message.content
+    except Exception as e:
+        # Keep the previous summary; the window just stays a little longer
+        print(f"Summary Error ({API_PROVIDER}):", e)
+        return
+
+    # The summary call runs unlocked so the next turn isn't held up; messages
+    # are append-only, so [start:end) is still what was summarized
+    async with conversation_lock(cid):
+        conv = await load_conv(cid)
+        if not conv or conv.get("summary_end", 1) != start:
+            return
+        conv["summary"] = summary
+        conv["summary_end"] = end
+        await save_conv(cid, conv)
+
+def analysis_messages(conversation_history):
+    # The full history followed by fixed instructions. The provider's prefix
+    # cache is per model and chat requests send a windowed context, so this
+    # only reuses the chat turns' cache when CHAT_MODEL == ANALYSIS_MODEL and
+    # the conversation is still shorter than the first summary
+    return conversation_history + [ANALYSIS_REQUEST]
+
+async def analyze_conversation(conversation_history):
+    """Return the coach's feedback, or None if the analysis call failed"""
+    messages = analysis_messages(conversation_history)
+    key = cache_key(ANALYSIS_MODEL, 0.6, 1000, messages)
+    if key in RESP_CACHE:
+        return RESP_CACHE[key]
 
     try:
-        response = client.chat.completions.create(
-            model=MODEL,
-            messages=[
-                {"role": "system", "content": ANALYSIS_PROMPT},
-                {"role": "user", "content": f"Analyze this conversation and provide structured feedback:\n\n{formatted}"}
-            ],
+        response = await client.chat.completions.create(
+            model=ANALYSIS_MODEL,
+            messages=messages,
             temperature=0.6,
             max_tokens=1000
         )
-        return response.choices[0].message.content
+        analysis = response.choices[0].message.content
+        RESP_CACHE[key] = analysis
+        return analysis
     except Exception as e:
         print(f"Analysis Error ({API_PROVIDER}):", e)
-        return "Unable to analyze conversation. Please try again."
+        return None
+
+async def run_analysis(cid):
+    """Analyze a finished conversation and store the result on it"""
+    try:
+        async with conversation_lock(cid):
+            conv = await load_conv(cid)
+            if not conv:
+                return
+            if USE_BATCH_API:
+                conv["analysis_queued"] = True
+                queued_analyses.append((cid, analysis_messages(build_messages(conv))))
+            else:
+                analysis = await analyze_conversation(build_messages(conv))
+                if analysis:
+                    conv["analysis"] = analysis
+                else:
+                    # Flag rather than store text, so /end_conversation can retry
+                    conv["analysis_error"] = True
+            await save_conv(cid, conv)
+    finally:
+        pending_analyses.pop(cid, None)
+
+async def store_analysis(cid, analysis):
+    """Record a batch result; None marks the analysis as failed so it can be retried"""
+    async with conversation_lock(cid):
+        conv = await load_conv(cid)
+        if not conv:
+            print(f"Dropping batch analysis for expired conversation {cid}")
+            return
+        conv.pop("analysis_queued", None)
+        if analysis:
+            conv["analysis"] = analysis
+        else:
+            conv["analysis_error"] = True
+        await save_conv(cid, conv)
+
+async def submit_analysis_batches():
+    """Every ANALYSIS_BATCH_INTERVAL, upload queued analyses as one Batch API job"""
+    while True:
+        await asyncio.sleep(ANALYSIS_BATCH_INTERVAL)
+        if not queued_analyses:
+            continue
+
+        jobs = queued_analyses[:]
+        queued_analyses.clear()
+        lines = [
+            orjson.dumps({
+                "custom_id": cid,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": ANALYSIS_MODEL,
+                    "messages": messages,
+                    "temperature": 0.6,
+                    "max_tokens": 1000
+                }
+            })
+            for cid, messages in jobs
+        ]
+
+        try:
+            batch_file = await client.files.create(
+                file=("analyses.jsonl", b"\n".join(lines)),
+                purpose="batch"
+            )
+            batch = await client.batches.create(
+                input_file_id=batch_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window=ANALYSIS_BATCH_WINDOW
+            )
+        except Exception as e:
+            print(f"Batch Submit Error ({API_PROVIDER}):", e)
+            for cid, _ in jobs:
+                await store_analysis(cid, None)
+            continue
+
+        cids = [cid for cid, _ in jobs]
+        poller = asyncio.create_task(collect_analysis_batch(batch.id, cids))
+        running_batches[poller] = (batch.id, cids)
+        poller.add_done_callback(running_batches.pop)
+
+async def collect_analysis_batch(batch_id, cids):
+    """Wait for a batch to finish and write each analysis back to its conversation"""
+    results = None
+    while results is None:
+        await asyncio.sleep(ANALYSIS_BATCH_POLL)
+        try:
+            batch = await client.batches.retrieve(batch_id)
+            if batch.status not in ("completed", "failed", "expired", "cancelled"):
+                continue
+
+            finished = {}
+            if batch.output_file_id:
+                output = await client.files.content(batch.output_file_id)
+                for line in output.text.splitlines():
+                    if not line:
+                        continue
+                    result = orjson.loads(line)
+                    body = (result.get("response") or {}).get("body") or {}
+                    if body.get("choices"):
+                        finished[result["custom_id"]] = body["choices"][0]["message"]["content"]
+            results = finished
+        except Exception as e:
+            # The batch keeps running upstream, so a failed poll just waits for the next one
+            print(f"Batch Poll Error ({API_PROVIDER}):", e)
+
+    for cid in cids:
+        await store_analysis(cid, results.get(cid))
+
+async def wait_for_analysis(cid):
+    """Return the conversation once its analysis finished or failed, else None"""
+    # Poll the store rather than the local task: with Redis the analysis may
+    # be running in another worker
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + ANALYSIS_WAIT_TIMEOUT
+    while loop.time() < deadline:
+        conv = await load_conv(cid)
+        if not conv:
+            return None
+        if conv.get("analysis") or conv.get("analysis_error"):
+            return conv
+        await asyncio.sleep(ANALYSIS_POLL_INTERVAL)
+    return None
+
+@app.before_serving
+async def warm_greeting_pool():
+    schedule_greeting_refill()
+
+@app.before_serving
+async def start_analysis_batches():
+    global analysis_batch_task
+    if USE_BATCH_API:
+        analysis_batch_task = asyncio.create_task(submit_analysis_batches())
+        print("Submitting analyses through the OpenAI Batch API")
+
+@app.after_serving
+async def stop_greeting_refill():
+    if greeting_refill_task is not None:
+        greeting_refill_task.cancel()
+        await asyncio.gather(greeting_refill_task, return_exceptions=True)
+
+@app.after_serving
+async def stop_analysis_batches():
+    if analysis_batch_task is None:
+        return
+    abandoned = [cid for cid, _ in queued_analyses]
+    for batch_id, cids in running_batches.values():
+        print(f"Abandoning analysis batch {batch_id} ({len(cids)} conversations)")
+        abandoned += cids
+    if queued_analyses:
+        print(f"Abandoning {len(queued_analyses)} analyses not yet submitted")
+
+    tasks = [analysis_batch_task, *running_batches]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    # Nothing persists the queue, so mark these failed; /end_conversation can retry them
+    for cid in abandoned:
+        await store_analysis(cid, None)
+
+@app.after_serving
+async def stop_analyses():
+    tasks = list(pending_analyses.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+@app.after_serving
+async def stop_compactions():
+    for task in compaction_tasks:
+        task.cancel()
+    await asyncio.gather(*compaction_tasks, return_exceptions=True)
+
+@app.after_serving
+async def close_http_client():
+    await http_client.aclose()
 
 @app.route('/')
-def index():
+async def index():
     """Landing page"""
-    return render_template('welcome.html')
+    return await render_template('welcome.html')
 
 @app.route('/conversation')
-def conversation():
+async def conversation():
     """Conversation page"""
     conversation_id = session.get('conversation_id')
     
-    if not conversation_id or conversation_id not in conversations:
+    if not await load_conv(conversation_id):
         return redirect(url_for('index'))
     
-    return render_template('conversation.html', 
+    return await render_template('conversation.html', 
                          conversation_id=conversation_id)
 
 @app.route('/feedback')
-def feedback():
+async def feedback():
     """Feedback page"""
     conversation_id = session.get('conversation_id')
+    conv = await load_conv(conversation_id)
     
-    if not conversation_id or conversation_id not in conversations:
+    if not conv:
         return redirect(url_for('index'))
     
-    analysis = session.get('analysis', 'No feedback available.')
-    total_turns = conversations.get(conversation_id, {}).get('turns', 0)
+    # None while the analysis is still running; the page then waits on /feedback_stream
+    analysis = conv.get('analysis')
+    total_turns = conv.get('turns', 0)
     
-    return render_template('feedback.html', 
+    return await render_template('feedback.html', 
+                         conversation_id=conversation_id,
                          analysis=analysis,
                          total_turns=total_turns)
 
 @app.route('/start_conversation', methods=['POST'])
-def start_conversation():
+async def start_conversation():
     conversation_id = str(uuid.uuid4())
-    conversations[conversation_id] = {
-        "messages": [{"role": "system", "content": SYSTEM_PROMPT}],
-        "turns": 0,
-        "started_at": datetime.now().isoformat()
-    }
+    conv = new_conv()
 
-    greeting = get_ai_response(
-        conversations[conversation_id]["messages"] + [
-            {"role": "user", "content": "Hi! I'd like to practice my conversation skills."}
-        ]
-    )
+    if greeting_pool:
+        greeting = greeting_pool.popleft()
+    else:
+        greeting = await get_ai_response(GREETING_MESSAGES)
+    if len(greeting_pool) < GREETING_REFILL_AT:
+        schedule_greeting_refill()
 
-    conversations[conversation_id]["messages"].append(
-        {"role": "assistant", "content": greeting}
-    )
+    add_message(conv, ROLE_ASSISTANT, greeting)
+    await save_conv(conversation_id, conv)
     
     session['conversation_id'] = conversation_id
 
@@ -199,49 +703,118 @@ def start_conversation():
     })
 
 @app.route('/send_message', methods=['POST'])
-def send_message():
-    data = request.json
+async def send_message():
+    data = await request.get_json()
     cid = data.get("conversation_id")
     msg = data.get("message")
 
-    if cid not in conversations:
+    if not await load_conv(cid):
         return jsonify({"error": "Invalid conversation"}), 400
 
-    conversations[cid]["messages"].append({"role": "user", "content": msg})
-    conversations[cid]["turns"] += 1
-
-    reply = get_ai_response(conversations[cid]["messages"])
-    conversations[cid]["messages"].append({"role": "assistant", "content": reply})
-
-    return jsonify({
-        "response": reply,
-        "turn_count": conversations[cid]["turns"]
-    })
+    @stream_with_context
+    async def generate():
+        async with conversation_lock(cid):
+            conv = await load_conv(cid)
+            add_message(conv, ROLE_USER, msg)
+            conv["turns"] += 1
+            turn_count = conv["turns"]
+
+            reply = []
+            completed = False
+            try:
+                vec, cached = await semantic_lookup(conv)
+                if cached:
+                    reply.append(cached)
+                    yield sse_frame({'token': cached})
+                else:
+                    async for token in stream_ai_response(chat_context(conv)):
+                        if token:
+                            reply.append(token)
+                            yield sse_frame({'token': token})
+                    semantic_store(vec, "".join(reply))
+                completed = True
+                yield sse_frame({'done': True, 'turn_count': turn_count})
+            except Exception as e:
+                print(f"AI Error ({API_PROVIDER}):", e)
+                yield sse_frame({'error': ERROR_REPLY})
+            finally:
+                if completed:
+                    add_message(conv, ROLE_ASSISTANT, "".join(reply))
+                    await save_conv(cid, conv)
+                    if turn_count % SUMMARY_EVERY == 0:
+                        schedule_compaction(cid)
+                else:
+                    # Failed or abandoned turn: drop it so no partial reply (or a
+                    # dangling user message) is sent back to the model later
+                    pop_message(conv)
+                    conv["turns"] -= 1
+
+    return Response(
+        generate(),
+        mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @app.route('/end_conversation', methods=['POST'])
-def end_conversation():
-    cid = request.json.get("conversation_id")
+async def end_conversation():
+    cid = (await request.get_json()).get("conversation_id")
 
-    if cid not in conversations:
-        return jsonify({"error": "Invalid conversation"}), 400
+    # Check and start under the lock so two retries can't both start an analysis
+    async with conversation_lock(cid):
+        conv = await load_conv(cid)
+
+        if not conv:
+            return jsonify({"error": "Invalid conversation"}), 400
 
-    analysis = analyze_conversation(conversations[cid]["messages"])
-    session['analysis'] = analysis
+        if not conv.get("analysis") and not conv.get("analysis_queued") and cid not in pending_analyses:
+            if conv.pop("analysis_error", None):
+                # Clear the last failure before redirecting so /feedback_stream waits for the retry
+                await save_conv(cid, conv)
+            pending_analyses[cid] = asyncio.create_task(run_analysis(cid))
 
     return jsonify({
         "redirect": url_for('feedback')
     })
 
+@app.route('/feedback_stream')
+async def feedback_stream():
+    """SSE endpoint that delivers the analysis once the background task finishes"""
+    conversation_id = session.get('conversation_id')
+
+    if not await load_conv(conversation_id):
+        return jsonify({"error": "Invalid conversation"}), 400
+
+    async def generate():
+        conv = await wait_for_analysis(conversation_id)
+        if conv and conv.get("analysis"):
+            yield sse_frame({"analysis": conv["analysis"]})
+        elif conv:
+            yield sse_frame({"error": "Unable to analyze conversation. Please try again."})
+        else:
+            # Still running (e.g. queued in a Batch API job) - the page asks the user to come back
+            yield sse_frame({"pending": True})
+
+    response = Response(
+        generate(),
+        mimetype='text/event-stream',
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+    # The wait can outlast Quart's default RESPONSE_TIMEOUT of 60s
+    response.timeout = None
+    return response
+
 @app.route('/get_greeting', methods=['GET'])
-def get_greeting():
+async def get_greeting():
     """Get the initial greeting for the conversation page"""
     conversation_id = session.get('conversation_id')
+    conv = await load_conv(conversation_id)
     
-    if not conversation_id or conversation_id not in conversations:
+    if not conv:
         return jsonify({"error": "Invalid conversation"}), 400
     
-    messages = conversations[conversation_id]["messages"]
-    greeting = next((m["content"] for m in messages if m["role"] == "assistant"), "")
+    greeting = next(
+        (c for r, c in zip(conv["roles"], conv["contents"]) if r == ROLE_ASSISTANT), ""
+    )
     
     return jsonify({
         "greeting": greeting,
@@ -249,15 +822,17 @@ def get_greeting():
     })
 
 @app.route('/health')
-def health():
+async def health():
     """Health check endpoint for Render"""
     return jsonify({
         "status": "healthy",
         "api_provider": API_PROVIDER,
-        "model": MODEL
+        "chat_model": CHAT_MODEL,
+        "analysis_model": ANALYSIS_MODEL
     }), 200
 
 if __name__ == '__main__':
-    # For local development
+    # For local development only - production runs under hypercorn (see Procfile)
     port = int(os.environ.get('PORT', 5001))
-    app.run(debug=True, host='0.0.0.0', port=port)
+    debug = os.environ.get('DEBUG', '').lower() in ('1', 'true')
+    app.run(debug=debug, host='0.0.0.0', port=port)